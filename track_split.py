@@ -1,12 +1,17 @@
 import subprocess
 import argparse
+import concurrent.futures
+import functools
 import traceback
-from collections import defaultdict
 import json
 import os, os.path
-import datetime
+import re
+import sys
 
-FILE_TAGS = {'file', 'start', 'end', 'tracks'}
+FILE_TAGS = {'file', 'start', 'end', 'tracks', 'number'}
+FFMPEG_PARAMS = ('ffmpeg', '-y', '-nostdin', '-loglevel', 'error')
+FRAMES_PER_SECOND = 75
+MICROSECONDS_PER_SECOND = 1000000
 INVALID_CHARACTERS = {
     '<': '‹', 
     '>': '›', 
@@ -18,13 +23,20 @@ INVALID_CHARACTERS = {
     '?': '？', 
     '*': '＊'
 }
+INVALID_CHARACTERS_TABLE = str.maketrans(INVALID_CHARACTERS)
+# https://ffmpeg.org/ffmpeg-formats.html#Metadata-2
+FFMETADATA_ESCAPE_TABLE = str.maketrans({character: f'\\{character}' for character in '=;#\\\n'})
+# Splits "COMMAND rest of the line" into its two fields, trimming whitespace
+FIELDS_PATTERN = re.compile(r'\s*(\S*)\s*(.*?)\s*')
 
 # https://en.wikipedia.org/wiki/Cue_sheet_(computing)
 # https://www.gnu.org/software/ccd2cue/manual/html_node/CUE-sheet-format.html#CUE-sheet-format
 class CueParser():
-    def __init__(self, offset='00:00:00.00'):
+    def __init__(self, offset=0):
         self._clear()
         self.offset = offset
+        self._disc_parsers = {'REM': self._parse_comment_tag}
+        self._track_parsers = {'INDEX': self._parse_index_tag, 'REM': self._parse_comment_tag}
 
     def info(self):
         if not self._info:
@@ -36,64 +48,65 @@ class CueParser():
 
     def parse(self, doc):
         self._clear()
-        self._parse_disc(doc)
-        line = self._readline(doc)
-        self._parse_track_tag(line)
-        while line:
-            line = self._parse_track(doc)
+        # Text mode already normalises line endings; splitlines() would also
+        # break on characters such as \x85 or \u2028 inside a tag
+        self._lines = iter(doc.read().split('\n'))
+        self._parse_disc()
+        command, value = self._readline()
+        if command == 'TRACK':
+            self._parse_track_tag(value)
+        while command:
+            command = self._parse_track()
         self._complete_endings()
         self._get_unique_titles()
 
-    def _parse_disc(self, doc):
-        line = self._readline(doc)
-        while line and not self._parse_file_tag(line):
-            if not self._parse_comment_tag(self._disc, line):
-                self._parse_tag(self._disc, line)
-            line = self._readline(doc)
-
-    def _parse_track(self, doc):
-        line = self._readline(doc)
-        while line and not self._parse_track_tag(line):
-            if not self._parse_index_tag(line):
-                if not self._parse_comment_tag(self._tracks[-1], line):
-                    self._parse_tag(self._tracks[-1], line)
-            line = self._readline(doc)
-        return line
-
-    def _parse_index_tag(self, line):
-        fields = line.split(maxsplit=2)
-        if len(fields) == 3 and fields[0] == 'INDEX':
-            timestamp = convert_timestamp(fields[2], offset=self.offset)
-            if fields[1] == '01':
-                return self._parse_tag(self._tracks[-1], f'START {timestamp}')
+    def _parse_disc(self):
+        command, value = self._readline()
+        while command and not (command == 'FILE' and self._parse_file_tag(value)):
+            self._parse_command(self._disc, command, value, self._disc_parsers)
+            command, value = self._readline()
+
+    def _parse_track(self):
+        command, value = self._readline()
+        while command and not (command == 'TRACK' and self._parse_track_tag(value)):
+            self._parse_command(self._tracks[-1], command, value, self._track_parsers)
+            command, value = self._readline()
+        return command
+
+    def _parse_command(self, target, command, value, parsers):
+        parser = parsers.get(command)
+        if not (parser and parser(target, value)):
+            self._parse_tag(target, command, value)
+
+    def _parse_index_tag(self, target, value):
+        number, timestamp = FIELDS_PATTERN.fullmatch(value).groups()
+        if timestamp:
+            timestamp = convert_timestamp(timestamp, offset=self.offset)
+            if number == '01':
+                return self._parse_tag(target, 'START', timestamp)
             elif len(self._tracks) - 2 >= 0:
-                return self._parse_tag(self._tracks[-2], f'END {timestamp}')
+                return self._parse_tag(self._tracks[-2], 'END', timestamp)
         return False
 
-    def _parse_track_tag(self, line):
-        fields = line.split(maxsplit=2)
-        if len(fields) == 3 and fields[0] == 'TRACK':
-            track = defaultdict(str)
+    def _parse_track_tag(self, value):
+        number, kind = FIELDS_PATTERN.fullmatch(value).groups()
+        if kind:
+            track = {'number': int(number)}
             self._tracks.append(track)
-            return self._parse_tag(track, line.rpartition(' ')[0])
+            return self._parse_tag(track, 'TRACK', number)
         return False
 
-    def _parse_file_tag(self, line):
-        fields = line.split(maxsplit=1)
-        if len(fields) == 2 and fields[0] == 'FILE':
-            return self._parse_tag(self._disc, line.rpartition(' ')[0])
-        return False
+    def _parse_file_tag(self, value):
+        return self._parse_tag(self._disc, 'FILE', value.rpartition(' ')[0])
 
-    def _parse_comment_tag(self, target, line):
-        fields = line.split(maxsplit=2)
-        if len(fields) == 3 and fields[0] == 'REM':
-            return self._parse_tag(target, ' '.join(fields[1:]))
-        return False
+    def _parse_comment_tag(self, target, value):
+        key, value = FIELDS_PATTERN.fullmatch(value).groups()
+        return self._parse_tag(target, key, value)
 
-    def _parse_tag(self, target, line):
-        fields = line.split(maxsplit=1)
-        if len(fields) == 2:
-            target[fields[0].lower()] = fields[1].strip('\'"')
+    def _parse_tag(self, target, key, value):
+        if value:
+            # Tag names repeat on every track, as do per-track values such as a shared PERFORMER
+            target[sys.intern(key.lower())] = sys.intern(value.strip('\'"'))
             return True
         return False
 
@@ -104,73 +117,95 @@ class CueParser():
                     self._tracks[i]['end'] = self._tracks[i + 1]['start']
 
     def _get_unique_titles(self):
-        titles = defaultdict(int)
+        titles = {}
         for track in self._tracks:
-            title = track['title']
-            if title in titles:
+            title = track.get('title', '')
+            count = titles.get(title, 0)
+            if count:
                 if 'performer' in track:
-                    title = f'{title} ({track["performer"]} ver.)'
-                    track['title'] = title
+                    track['title'] = f'{title} ({track["performer"]} ver.)'
                 else:
-                    track['title'] = f'{title} (ver. {titles[title]})'
-            titles[title] += 1
+                    track['title'] = f'{title} (ver. {count})'
+            titles[title] = count + 1
 
-    def _readline(self, doc):
-        return doc.readline().strip()
+    def _readline(self):
+        return FIELDS_PATTERN.fullmatch(next(self._lines, '')).groups()
 
     def _clear(self):
-        self._disc = defaultdict(str)
+        self._disc = {}
         self._tracks = []
+        self._lines = iter(())
         self._info = None
 
 def cut_video(src, dst, disc, track, options):
-    params = [
-        'ffmpeg',
-        '-y',
-        '-ss', track['start']
-    ]
+    # -ss/-to are input options (before -i), so ffmpeg seeks straight to the
+    # track instead of decoding the source from the beginning.
+    # https://trac.ffmpeg.org/wiki/Seeking
+    params = [*FFMPEG_PARAMS, '-ss', track['start']]
 
     if 'end' in track:
         params += ['-to', track['end']]
 
+    # Tags are fed through stdin as an ffmetadata document, keeping the
+    # command line the same size however many tags the CUE sheet has.
+    # ffmpeg never overwrites tags copied by an earlier -map_metadata, so
+    # the CUE tags are mapped first and the source's own tags fill the rest.
     params += [
         '-i', src,
+        '-f', 'ffmetadata', '-i', 'pipe:0',
+        '-map_metadata', '1',
+        '-map_metadata', '0',
     ]
 
-    metadata = track.copy()
-    for key, val in disc.items():
-        if key not in track:
-            metadata[key] = val
-    for key in FILE_TAGS:
-        if key in metadata:
-            del metadata[key]
-    metadata['track'] = f'{int(metadata["track"])}/{len(disc["tracks"])}'
-    metadata['album'] = disc['title']
+    metadata = {key: val for key, val in {**disc, **track}.items() if key not in FILE_TAGS}
+    metadata['track'] = f'{track["number"]}/{len(disc["tracks"])}'
+    metadata['album'] = disc.get('title', '')
     if 'artist' not in metadata and 'performer' in metadata:
         metadata['artist'] = metadata['performer']
     if 'album_artist' not in metadata and 'performer' in disc:
         metadata['album_artist'] = disc['performer']
 
-    for key, val in metadata.items():
-        params += [
-            '-metadata', f'{key}={val}'
-        ]
-
     if options.audio_codec:
         params += ['-c:a', options.audio_codec]
     params += [dst]
-    subprocess.run(params)
+    subprocess.run(params, input=to_ffmetadata(metadata).encode('utf-8'), check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+def to_ffmetadata(metadata):
+    lines = [';FFMETADATA1']
+    for key, val in metadata.items():
+        lines.append(f'{key.translate(FFMETADATA_ESCAPE_TABLE)}={val.translate(FFMETADATA_ESCAPE_TABLE)}')
+    return '\n'.join(lines) + '\n'
+
+@functools.lru_cache(maxsize=None)
+def convert_timestamp(timestamp, offset=0):
+    # CUE timestamps are MM:SS:FF with 75 frames per second; the offset is in microseconds
+    minutes, seconds, frames = timestamp.split(':')
+    microseconds = (int(minutes) * 60 + int(seconds)) * MICROSECONDS_PER_SECOND
+    microseconds += int(frames) * MICROSECONDS_PER_SECOND // FRAMES_PER_SECOND + offset
+    # A negative offset can move the first track before the start of the file
+    microseconds = max(microseconds, 0)
+    seconds, microseconds = divmod(microseconds, MICROSECONDS_PER_SECOND)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours:02d}:{minutes:02d}:{seconds:02d}.{microseconds:06d}'
 
-def convert_timestamp(timestamp, format='%M:%S:%f', offset='00:00:00.00'):
-    original = datetime.datetime.strptime(timestamp, format)
-    base = datetime.datetime.strptime('00:00:00', format)
-    diff = datetime.datetime.strptime(offset, '%H:%M:%S.%f')
-    return (original + (diff - base)).strftime('%H:%M:%S.%f')
+def convert_offset(offset):
+    # The sign applies to the whole offset, e.g. -00:00:01.00 is one second earlier
+    sign = -1 if offset.startswith('-') else 1
+    fields = (offset[1:] if sign < 0 else offset).split(':')
+    if len(fields) != 3 or not all(field[:1].isdigit() for field in fields):
+        raise ValueError(f'Invalid offset "{offset}", expected [-]HH:MM:SS.ff')
+    hours, minutes, seconds = fields
+    return sign * ((int(hours) * 60 + int(minutes)) * 60 * MICROSECONDS_PER_SECOND + round(float(seconds) * MICROSECONDS_PER_SECOND))
 
 def replace_invalid_characters(title):
-    for character in INVALID_CHARACTERS:
-        title = title.replace(character, INVALID_CHARACTERS[character])
-    return title.strip()
+    return title.translate(INVALID_CHARACTERS_TABLE).strip()
+
+def positive_int(value):
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+    return number
 
 def options():
     parser = argparse.ArgumentParser(description='Split audio tracks')
@@ -179,20 +214,66 @@ def options():
     parser.add_argument('--audio-format', type=str, default='flac', help='output audio format')
     parser.add_argument('--audio-codec', type=str, default=None, help='output audio codec')
     parser.add_argument('--text-encoding', type=str, default='mbcs', help='text encoding')
-    parser.add_argument('--offset', type=str, default='00:00:00.00', help='track offset')
+    parser.add_argument('--offset', type=convert_offset, default='00:00:00.00', help='track offset')
+    parser.add_argument('-j', '--jobs', type=positive_int, default=os.cpu_count(), help='number of tracks to split in parallel')
     return parser.parse_args()
 
 if __name__ == "__main__":
     options = options()
-    if not os.path.exists(options.output):
-        os.makedirs(options.output)
+    os.makedirs(options.output, exist_ok=True)
     
     # https://docs.python.org/3/library/codecs.html#standard-encodings
-    document = open(options.input, 'r', encoding=options.text_encoding)
     cue = CueParser(offset=options.offset)
-    cue.parse(document)
+    with open(options.input, 'r', encoding=options.text_encoding, buffering=65536) as document:
+        cue.parse(document)
+
+    info = cue.info()
+    src = os.path.join(os.path.dirname(options.input), info['file'])
+
+    # Tracks are split concurrently, so two of them must never write the same
+    # file: titles can still collide after deduplication or character replacement
+    destinations = []
+    used = set()
+    for track in info['tracks']:
+        name = replace_invalid_characters(track.get('title', ''))
+        dst = os.path.join(options.output, f'{name}.{options.audio_format}')
+        count = 1
+        # Case-insensitive filesystems (Windows, default macOS) treat "Song" and "song" as one file
+        while os.path.normcase(dst).casefold() in used:
+            count += 1
+            dst = os.path.join(options.output, f'{name} ({count}).{options.audio_format}')
+        used.add(os.path.normcase(dst).casefold())
+        destinations.append(dst)
 
-    for track in cue.info()['tracks']:
-        src = os.path.join(os.path.split(options.input)[0], cue.info()["file"])
-        dst = os.path.join(options.output, f'{replace_invalid_characters(track["title"])}.{options.audio_format}')
-        cut_video(src, dst, cue.info(), track, options)
+    # ffmpeg runs out of process, so threads are enough to keep every core busy
+    failed = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) as executor:
+        futures = {
+            executor.submit(cut_video, src, dst, info, track, options): track
+            for track, dst in zip(info['tracks'], destinations)
+        }
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                if future.cancelled():
+                    continue
+                try:
+                    future.result()
+                except Exception as error:
+                    failed = True
+                    if isinstance(error, subprocess.CalledProcessError):
+                        reason = error.stderr.decode(errors='replace')
+                    else:
+                        reason = f'{type(error).__name__}: {error}'
+                    print(f'Failed to split "{futures[future].get("title", "")}":\n{reason}', file=sys.stderr)
+                    # ffmpeg could not be started at all, so every other track would fail too
+                    if isinstance(error, OSError):
+                        for pending in futures:
+                            pending.cancel()
+        except BaseException:
+            # Leaving the with block waits for every queued track, so drop the
+            # ones that have not started yet (e.g. on Ctrl-C) before re-raising
+            for future in futures:
+                future.cancel()
+            raise
+    if failed:
+        sys.exit(1)